@@ -1,8 +1,17 @@
+import asyncio
+import functools
+import multiprocessing
+import os
 import platform
+import secrets
 import socket
+import struct
 import subprocess
-import threading
+import time
 
+import dns.asyncresolver
+import dns.exception
+import dns.flags
 import dns.resolver
 import dns.message
 import dns.query
@@ -18,149 +27,484 @@ import logging
 import sqlite_database
 
 # Set up logging configuration
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 DNS_RESOLVER = '8.8.8.8'
+DNS_RESOLVER_PORT = 53
+UPSTREAM_TIMEOUT = 2  # seconds
+# Forwarded queries are spread over a few connected sockets, each on its own
+# kernel-chosen ephemeral port; every socket is replaced after
+# UPSTREAM_ROTATE_INTERVAL so that the source port keeps changing.
+UPSTREAM_POOL_SIZE = 4
+UPSTREAM_ROTATE_INTERVAL = 60  # seconds
+ANSWER_TTL = 3600
+
+# Fixed 12-byte DNS header: id, flags, qdcount, ancount, nscount, arcount
+DNS_HEADER = struct.Struct('!HHHHHH')
+QR_FLAG = 0x8000
+RD_FLAG = 0x0100
+
+MAX_DATAGRAM = 512  # DNS packet size max is 512 bytes
+RECV_BATCH = 64  # datagrams read per wake-up of the listening socket
 
 # Load special domain configurations from a YAML file
 def load_config(config_file="config.yml"):
-    logging.debug(f"Loading configuration from {config_file}")
+    logging.debug("Loading configuration from %s", config_file)
     try:
         with open(config_file, 'r') as file:
             config = yaml.safe_load(file)
             logging.info("Configuration loaded successfully.")
             return config
     except Exception as e:
-        logging.error(f"Failed to load configuration: {e}")
+        logging.error("Failed to load configuration: %s", e)
         raise
 
+@functools.lru_cache(maxsize=4096)
 def is_valid_ip(ip):
     """Check if the input is a valid IP address (IPv4 or IPv6)."""
     try:
-        socket.inet_pton(socket.AF_INET, ip)  # IPv4
-        return "IPv4"
-    except socket.error:
-        try:
+        # Only IPv6 addresses contain ':', so each input needs a single parse attempt
+        if ':' in ip:
             socket.inet_pton(socket.AF_INET6, ip)  # IPv6
             return "IPv6"
-        except socket.error:
-            return None
+        socket.inet_pton(socket.AF_INET, ip)  # IPv4
+        return "IPv4"
+    except OSError:
+        return None
+
+def pack_ip(ip):
+    """Return the packed 4-byte (IPv4) or 16-byte (IPv6) form of an IP address, or None."""
+    ip_type = is_valid_ip(ip)
+    if ip_type == "IPv4":
+        return socket.inet_pton(socket.AF_INET, ip)
+    if ip_type == "IPv6":
+        return socket.inet_pton(socket.AF_INET6, ip)
+    return None
+
+def unpack_ip(packed):
+    """Format a packed IP address back to text."""
+    return socket.inet_ntop(socket.AF_INET if len(packed) == 4 else socket.AF_INET6, packed)
 
-def get_ip_or_domain(input_str):
+async def get_ip_or_domain(input_str):
     """Resolve domain name to its IP address using dnspython."""
     if is_valid_ip(input_str):
         return input_str  # If it's already an IP address, return it.
     else:
         try:
             # Resolve domain name to its IP address using dnspython
-            answer = dns.resolver.resolve(input_str, 'A')  # 'A' record for IPv4
+            answer = await dns.asyncresolver.resolve(input_str, 'A')  # 'A' record for IPv4
             return answer[0].to_text()  # Return the first resolved IP
         except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.exception.DNSException) as e:
             return input_str
 
+# Names and rdata are immutable in dnspython, so the parsed objects are reused
+# across responses instead of being rebuilt for every answer.
+@functools.lru_cache(maxsize=4096)
+def _dns_name(domain):
+    return dns.name.from_text(domain)
+
+@functools.lru_cache(maxsize=4096)
+def _ip_rdata(rdtype, ip):
+    if rdtype == dns.rdatatype.A:
+        return dns.rdtypes.IN.A.A(dns.rdataclass.IN, dns.rdatatype.A, ip)
+    return dns.rdtypes.IN.AAAA.AAAA(dns.rdataclass.IN, dns.rdatatype.AAAA, ip)
+
 # Create a DNS answer record for A (IPv4) or AAAA (IPv6) records
 def create_dns_record(domain, ttl, ip):
     """Create DNS records (A for IPv4, AAAA for IPv6) for a domain with a specified TTL and IP."""
     ip_type = is_valid_ip(ip)
 
     if ip_type == "IPv4":
-        logging.debug(f"Creating A record for domain: {domain} with IP: {ip} and TTL: {ttl}")
-        name = dns.name.from_text(domain)
-        rdata = dns.rdtypes.IN.A.A(dns.rdataclass.IN, dns.rdatatype.A, ip)
-        rrset = dns.rrset.RRset(name, dns.rdataclass.IN, dns.rdatatype.A)
-        rrset.add(rdata)
+        logging.debug("Creating A record for domain: %s with IP: %s and TTL: %s", domain, ip, ttl)
+        rdtype = dns.rdatatype.A
     elif ip_type == "IPv6":
-        logging.debug(f"Creating AAAA record for domain: {domain} with IP: {ip} and TTL: {ttl}")
-        name = dns.name.from_text(domain)
-        rdata = dns.rdtypes.IN.AAAA.AAAA(dns.rdataclass.IN, dns.rdatatype.AAAA, ip)
-        rrset = dns.rrset.RRset(name, dns.rdataclass.IN, dns.rdatatype.AAAA)
-        rrset.add(rdata)
+        logging.debug("Creating AAAA record for domain: %s with IP: %s and TTL: %s", domain, ip, ttl)
+        rdtype = dns.rdatatype.AAAA
     else:
         raise ValueError("Invalid IP address format")
 
+    rrset = dns.rrset.RRset(_dns_name(domain), dns.rdataclass.IN, rdtype)
+    rrset.add(_ip_rdata(rdtype, ip))
     rrset.ttl = ttl
     return rrset
 
+class SpecialDomain:
+    """One configured name from special_domains: a domain itself or one of its subdomains."""
+    __slots__ = ('domain', 'subdomain', 'target', 'is_mdns')
+
+    def __init__(self, domain, subdomain, target):
+        self.domain = domain
+        self.subdomain = subdomain
+        self.target = target
+        self.is_mdns = target.endswith('.local')
+
+# Special domains by lowercased name, plus the same domains indexed by reversed
+# labels for subdomain matching: "maxim.com" is stored under trie["com"]["maxim"]
+# and the None key of that node maps each of its subdomains to a SpecialDomain.
+_EXACT_DOMAINS = {}
+_DOMAIN_TRIE = {}
+
+def index_special_domains(special_domains):
+    """Build the exact-match dict and the reverse-label trie for the special_domains config section."""
+    exact = {}
+    trie = {}
+    for domain, config_data in special_domains.items():
+        domain = domain.lower()
+        exact[domain] = SpecialDomain(domain, None, config_data["ip"])
+        node = trie
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        node[None] = {sub.lower(): SpecialDomain(domain, sub.lower(), target)
+                      for sub, target in (config_data.get('subdomains') or {}).items()}
+    return exact, trie
+
+def match_special_domain(qname):
+    """Return the SpecialDomain configured for a lowercase qname, or None.
+
+    Exact domains are a dict lookup; otherwise the trie is walked once and the
+    deepest special domain is tried first."""
+    entry = _EXACT_DOMAINS.get(qname)
+    if entry is not None:
+        return entry
+
+    labels = qname.split('.')
+    node = _DOMAIN_TRIE
+    matches = []
+    for depth, label in enumerate(reversed(labels), 1):
+        node = node.get(label)
+        if node is None:
+            break
+        if None in node:
+            matches.append((depth, node[None]))
+
+    for depth, subdomains in reversed(matches):
+        entry = subdomains.get('.'.join(labels[:len(labels) - depth]))
+        if entry is not None:
+            return entry
+    return None
+
+def peek_question(data):
+    """Read the question of a single-question query straight from the wire.
+
+    Returns (lowercase qname, qtype, qclass, end offset of the question), or None
+    when the packet needs the full dnspython parser (several questions, not a
+    query, unusual labels). Additional records such as EDNS are not read."""
+    if len(data) < DNS_HEADER.size:
+        return None
+    _, flags, qdcount, ancount, nscount, _ = DNS_HEADER.unpack_from(data)
+    # Only standard queries (QR and opcode bits clear) with a single question
+    if flags & 0xF800 or qdcount != 1 or ancount or nscount:
+        return None
+
+    labels = []
+    offset = DNS_HEADER.size
+    try:
+        length = data[offset]
+        while length:
+            if length > 63:
+                return None  # Compression pointer or extended label type
+            label = data[offset + 1:offset + 1 + length]
+            if b'.' in label:
+                return None
+            labels.append(label)
+            offset += 1 + length
+            length = data[offset]
+        qtype, qclass = struct.unpack_from('!HH', data, offset + 1)
+        qname = b'.'.join(labels).decode('ascii').lower()
+    except (IndexError, struct.error, UnicodeDecodeError):
+        return None
+    return qname, qtype, qclass, offset + 5
+
+def answer_from_cache(data, qname, qtype, qclass, question_end):
+    """Build a response for a cached upstream resolution directly on the query bytes.
+
+    Returns None when there is no cached IP matching the query type, or when the
+    query carries additional records (EDNS) that the reply would have to echo."""
+    _, flags, _, _, _, arcount = DNS_HEADER.unpack_from(data)
+    if arcount or qclass != dns.rdataclass.IN:
+        return None
+    subdomain, domain = separate_domain_and_subdomain(qname)
+    # The cache holds packed addresses, which are the A/AAAA rdata as is
+    rdata = sqlite_database.get_cached(domain, subdomain)
+    if rdata is None:
+        return None
+    if not (len(rdata) == 4 and qtype == dns.rdatatype.A or len(rdata) == 16 and qtype == dns.rdatatype.AAAA):
+        return None
+    sqlite_database.queue_ip_for_storage(domain, subdomain, rdata)
+
+    response = bytearray(data[:question_end])
+    # Flip QR, keep RD, one question and one answer
+    struct.pack_into('!HHHHH', response, 2, QR_FLAG | (flags & RD_FLAG), 1, 1, 0, 0)
+    # Answer name is a compression pointer to the question name at offset 12
+    response += b'\xc0\x0c' + struct.pack('!HHIH', qtype, qclass, ANSWER_TTL, len(rdata)) + rdata
+    return bytes(response)
+
 # Handle DNS queries, checking the domain and subdomains against the config
-def handle_dns_query(data, client_address, config):
+async def handle_dns_query(data, client_address):
     """Handle incoming DNS query and resolve based on config."""
-    logging.debug(f"Handling DNS query from {client_address}")
-    query = dns.message.from_wire(data)
-    qname = query.question[0].name.to_text().strip('.')
-    logging.debug(f"Query for: {qname}")
-
-    # Search for the domain or subdomain in the config
-    for domain, config_data in config['special_domains'].items():
-        logging.debug(f"Checking domain: {domain} against config")
-        if qname == domain:
-            logging.info(f"Exact match for domain: {domain}")
-            if config_data["ip"].endswith('.local'):
-                logging.info(f"Handling mDNS query for .local domain: {qname}")
-                response = resolve_mdns(config_data["ip"], query, domain)
-                return response.to_wire()
-            else:
-                response = create_dns_entry(config_data["ip"], query, domain)
-                return response.to_wire()
-
-        # Handle subdomains
-        if qname.endswith('.' + domain):
-            subdomain = qname[:len(qname) - len(domain) - 1]  # Extract subdomain part
-            if subdomain in config_data['subdomains']:
-                logging.info(f"Match found for subdomain: {subdomain} under domain: {domain}")
-                if config_data['subdomains'][subdomain].endswith('.local'):
-                    logging.info(f"Handling mDNS query for .local domain: {qname}")
-                    response = resolve_mdns(config_data['subdomains'][subdomain], query, domain, subdomain)
-                    return response.to_wire()
-                else:
-                    response = create_dns_entry(config_data['subdomains'][subdomain], query, domain, subdomain)
-                    return response.to_wire()
+    logging.debug("Handling DNS query from %s", client_address)
+
+    # Decide from the raw question; the message is only parsed once a reply
+    # has to be built with dnspython
+    question = peek_question(data)
+    if question is not None:
+        qname, qtype, qclass, question_end = question
+        logging.debug("Query for: %s", qname)
+        # Search for the domain or subdomain in the config
+        entry = match_special_domain(qname)
+        if entry is None:
+            # Answer cached pass-through names on the raw packet
+            response = answer_from_cache(data, qname, qtype, qclass, question_end)
+            if response is not None:
+                logging.debug("Answered %s from cache", qname)
+                return response
+        query = dns.message.from_wire(data)
+    else:
+        query = dns.message.from_wire(data)
+        qname = query.question[0].name.to_text(omit_final_dot=True).lower()
+        logging.debug("Query for: %s", qname)
+        entry = match_special_domain(qname)
+
+    if entry is not None:
+        if entry.subdomain is None:
+            logging.debug("Exact match for domain: %s", entry.domain)
+        else:
+            logging.debug("Match found for subdomain: %s under domain: %s", entry.subdomain, entry.domain)
+        if entry.is_mdns:
+            logging.debug("Handling mDNS query for .local domain: %s", qname)
+            response = await resolve_mdns(entry.target, query, entry.domain, entry.subdomain)
+        else:
+            response = await create_dns_entry(entry.target, query, entry.domain, entry.subdomain)
+        return response.to_wire()
 
     # If no special config found, forward the query to Google's DNS
     try:
-        logging.debug(f"No match found, forwarding query to Google's DNS")
-        response = resolve_dns_entry(qname, query)
+        logging.debug("No match found, forwarding query to Google's DNS")
+        response = await resolve_dns_entry(qname, query)
     except Exception as e:
-        logging.error(f"Error querying Google's DNS: {e}")
+        logging.error("Error querying Google's DNS: %s", e)
         response = dns.message.make_response(query)
         response.set_rcode(dns.rcode.SERVFAIL)
 
-    return response.to_wire()
+    return render_response(response, query)
+
+def render_response(response, query):
+    """Render response within the UDP size the client advertised, truncating it if it does not fit."""
+    max_size = max(query.payload, MAX_DATAGRAM) if query.edns >= 0 else MAX_DATAGRAM
+    try:
+        return response.to_wire(max_size=max_size)
+    except dns.exception.TooBig:
+        logging.debug("Response too large for %s bytes, sending it truncated", max_size)
+        truncated = dns.message.make_response(query)
+        truncated.flags |= dns.flags.TC
+        truncated.set_rcode(response.rcode())
+        return truncated.to_wire()
+
+# Avahi answers are kept for the usual mDNS TTL so that the avahi-resolve
+# subprocess only runs on a miss, and failures for a few seconds so that a
+# missing host is not looked up again by every query. Concurrent queries for
+# the same host share one in-flight lookup.
+MDNS_TTL = 120  # seconds
+MDNS_FAILURE_TTL = 5  # seconds
+MDNS_TIMEOUT = 5  # seconds avahi-resolve may run before it is killed
+_MDNS_CACHE = {}
+_MDNS_INFLIGHT = {}
+
+async def _run_avahi_resolve(ip_host):
+    """Run avahi-resolve for ip_host and return the IP it prints, or None."""
+    process = await asyncio.create_subprocess_exec('avahi-resolve', '--name', ip_host,
+                                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), MDNS_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logging.error("Timed out resolving mDNS for %s", ip_host)
+        return None
+    if process.returncode != 0:
+        logging.error("Failed to resolve mDNS for %s", ip_host)
+        return None
+
+    # Parse the result
+    ip = stdout.decode().strip().split('\t')[1]  # Get the IP address from the output
+    ip_type = is_valid_ip(ip)
+    if ip_type == "IPv4":
+        logging.info("Resolved mDNS for %s to IPv4 address %s", ip_host, ip)
+    elif ip_type == "IPv6":
+        logging.info("Resolved mDNS for %s to IPv6 address %s", ip_host, ip)
+    else:
+        logging.error("Resolved mDNS for %s to an invalid IP: %s", ip_host, ip)
+        return None
+    return ip
+
+async def _resolve_and_cache_mdns_host(ip_host):
+    ip = await _run_avahi_resolve(ip_host)
+    ttl = MDNS_TTL if ip is not None else MDNS_FAILURE_TTL
+    _MDNS_CACHE[ip_host] = (ip, time.monotonic() + ttl)
+    return ip
 
-def resolve_mdns(ip_host, query, domain, subdomain=None):
+async def lookup_mdns_host(ip_host):
+    """Return the IP Avahi resolves ip_host to, or None if it cannot be resolved."""
+    entry = _MDNS_CACHE.get(ip_host)
+    if entry is not None and time.monotonic() < entry[1]:
+        return entry[0]
+
+    task = _MDNS_INFLIGHT.get(ip_host)
+    if task is None:
+        task = asyncio.ensure_future(_resolve_and_cache_mdns_host(ip_host))
+        _MDNS_INFLIGHT[ip_host] = task
+        task.add_done_callback(lambda _: _MDNS_INFLIGHT.pop(ip_host, None))
+    return await asyncio.shield(task)
+
+async def resolve_mdns(ip_host, query, domain, subdomain=None):
     """Resolve mDNS queries for .local domains using Avahi."""
     try:
-        # Run Avahi-resolve command to resolve .local domain
-        result = subprocess.run(['avahi-resolve', '--name', ip_host], capture_output=True, text=True)
-
-        if result.returncode == 0:
-            # Parse the result
-            ip = result.stdout.strip().split('\t')[1]  # Get the IP address from the output
-            ip_type = is_valid_ip(ip)
-
-            if ip_type == "IPv4":
-                logging.info(f"Resolved mDNS for {ip_host} to IPv4 address {ip}")
-            elif ip_type == "IPv6":
-                logging.info(f"Resolved mDNS for {ip_host} to IPv6 address {ip}")
-            else:
-                logging.error(f"Resolved mDNS for {ip_host} to an invalid IP: {ip}")
-                return dns.message.make_response(query).set_rcode(dns.rcode.SERVFAIL)
-
-            return create_dns_entry(ip, query, domain, subdomain)
-        else:
-            logging.error(f"Failed to resolve mDNS for {ip_host}")
-            return dns.message.make_response(query).set_rcode(dns.rcode.SERVFAIL)
+        ip = await lookup_mdns_host(ip_host)
+        if ip is not None:
+            return await create_dns_entry(ip, query, domain, subdomain)
     except Exception as e:
-        logging.error(f"Error resolving mDNS for {ip_host}: {e}")
-        return dns.message.make_response(query).set_rcode(dns.rcode.SERVFAIL)
+        logging.error("Error resolving mDNS for %s: %s", ip_host, e)
+    response = dns.message.make_response(query)
+    response.set_rcode(dns.rcode.SERVFAIL)
+    return response
+
+class UpstreamProto(asyncio.DatagramProtocol):
+    """One of the UDP sockets connected to DNS_RESOLVER that forwarded queries share.
+
+    Each outgoing query gets an unused random message ID, and replies are
+    matched back to their waiting future by that ID. A retired socket takes no
+    new queries and closes once the ones in flight are answered."""
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+        self.expires = time.monotonic() + UPSTREAM_ROTATE_INTERVAL
+        self.retired = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def retire(self):
+        self.retired = True
+        if not self.pending:
+            self.transport.close()
+
+    def datagram_received(self, data, addr):
+        if len(data) < DNS_HEADER.size:
+            return
+        future = self.pending.get(struct.unpack_from('!H', data)[0])
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        logging.debug("Upstream socket error: %s", exc)
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Upstream socket closed"))
+
+    async def query(self, query, timeout):
+        """Send query to the resolver and return its response, restored to the query's ID."""
+        upstream_id = secrets.randbits(16)
+        while upstream_id in self.pending:
+            upstream_id = secrets.randbits(16)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[upstream_id] = future
+        try:
+            wire = query.to_wire()
+            self.transport.sendto(struct.pack('!H', upstream_id) + wire[2:])
+            data = await asyncio.wait_for(future, timeout)
+        finally:
+            del self.pending[upstream_id]
+            if self.retired and not self.pending:
+                self.transport.close()
+
+        response = dns.message.from_wire(struct.pack('!H', query.id) + data[2:])
+        if not query.is_response(response):
+            raise dns.query.BadResponse
+        return response
+
+# Created by serve_dns() on the loop that uses them: before Python 3.10 an
+# asyncio.Lock binds to the event loop current when it is constructed.
+_upstream_pool = [None] * UPSTREAM_POOL_SIZE
+_upstream_lock = None
+
+def _upstream_usable(upstream):
+    return upstream is not None and not upstream.transport.is_closing() and time.monotonic() < upstream.expires
+
+async def get_upstream():
+    """Return a random socket from this process's upstream pool, opening or replacing it as needed."""
+    index = secrets.randbelow(UPSTREAM_POOL_SIZE)
+    upstream = _upstream_pool[index]
+    if _upstream_usable(upstream):
+        return upstream
+
+    # The lock keeps concurrent queries from each opening a socket for the same slot
+    async with _upstream_lock:
+        upstream = _upstream_pool[index]
+        if not _upstream_usable(upstream):
+            loop = asyncio.get_running_loop()
+            _, fresh = await loop.create_datagram_endpoint(UpstreamProto,
+                                                           remote_addr=(DNS_RESOLVER, DNS_RESOLVER_PORT))
+            _upstream_pool[index] = fresh
+            if upstream is not None:
+                upstream.retire()
+            upstream = fresh
+    return upstream
+
+# Upstream exchanges in flight keyed by question, so that clients asking the
+# same question at the same time share a single upstream query.
+_INFLIGHT = {}
+
+async def _exchange_upstream(qname, query):
+    upstream = await get_upstream()
+    return await asyncio.gather(
+        get_ip_or_domain(qname),
+        upstream.query(query, UPSTREAM_TIMEOUT),
+    )
 
-def resolve_dns_entry(qname, query):
+def _readdress_response(shared, query):
+    """Copy an upstream response obtained for another client's query onto a response to query."""
+    response = dns.message.make_response(query)
+    response.flags = shared.flags
+    # make_response answers with plain EDNS0; carry over the upstream's DO bit and options instead
+    response.use_edns(shared.edns, shared.ednsflags, shared.payload, query.payload, shared.options)
+    response.set_rcode(shared.rcode())
+    response.answer = shared.answer
+    response.authority = shared.authority
+    response.additional = shared.additional
+    return response
+
+async def forward_upstream(qname, query):
+    """Resolve qname upstream, returning (ip, response); concurrent identical questions are coalesced."""
+    question = query.question[0]
+    # Only queries with the same EDNS payload size, DO and CD bits can share a
+    # response: those decide how large it may be and whether it carries DNSSEC
+    key = (qname, question.rdtype, question.rdclass, query.edns, query.payload,
+           query.ednsflags & dns.flags.DO, query.flags & dns.flags.CD)
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_exchange_upstream(qname, query))
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(key, None))
+        return await asyncio.shield(task)
+
+    logging.debug("Joining in-flight upstream query for %s", qname)
+    ip, shared = await asyncio.shield(task)
+    return ip, _readdress_response(shared, query)
+
+async def resolve_dns_entry(qname, query):
     subdomain, domain = separate_domain_and_subdomain(qname)
-    if sqlite_database.check_if_resolution_valid(domain, subdomain):
-        ip = sqlite_database.get_ip_from_db(domain, subdomain)
-        response = create_dns_entry(ip, query, domain, subdomain)
-    else:
-        ip = get_ip_or_domain(qname)
-        response = dns.query.udp(query, DNS_RESOLVER)
-    threading.Thread(target=sqlite_database.store_ip_in_db, args=(domain, subdomain, ip)).start()
+    packed = sqlite_database.get_cached(domain, subdomain)
+    if packed is not None:
+        # create_dns_entry stores the resolution again
+        return await create_dns_entry(unpack_ip(packed), query, domain, subdomain)
+
+    ip, response = await forward_upstream(qname, query)
+    packed = pack_ip(ip)
+    # get_ip_or_domain hands back the name itself when the lookup fails
+    if packed is not None:
+        sqlite_database.queue_ip_for_storage(domain, subdomain, packed)
     return response
 
 def separate_domain_and_subdomain(qname):
@@ -173,15 +517,10 @@ def separate_domain_and_subdomain(qname):
         domain = qname
     return subdomain, domain
 
-def create_dns_entry(ip, query, domain, subdomain=None):
-    if sqlite_database.check_if_resolution_valid(domain, subdomain):
-        old_ip = sqlite_database.get_ip_from_db(domain, subdomain)
-        if str(old_ip) != str(ip):
-            ip = get_ip_or_domain(ip)
-        else:
-            ip = old_ip
-    else:
-        ip = get_ip_or_domain(ip)
+async def create_dns_entry(ip, query, domain, subdomain=None):
+    old_ip = sqlite_database.get_cached(domain, subdomain)
+    if old_ip is None or old_ip != pack_ip(ip):
+        ip = await get_ip_or_domain(ip)
 
     if subdomain:
         full_domain = f"{subdomain}.{domain}"
@@ -189,29 +528,118 @@ def create_dns_entry(ip, query, domain, subdomain=None):
         full_domain = domain
 
     response = dns.message.make_response(query)
-    answer = create_dns_record(full_domain, 3600, ip)
+    answer = create_dns_record(full_domain, ANSWER_TTL, ip)
     response.answer.append(answer)
-    threading.Thread(target=sqlite_database.store_ip_in_db, args=(domain, subdomain, ip)).start()
+    sqlite_database.queue_ip_for_storage(domain, subdomain, pack_ip(ip))
     return response
 
-def start_dns_server(host='0.0.0.0', port=1053, config_file="config.yml"):
-    """Start a DNS server that loads domain configs from a YAML file."""
-    sqlite_database.create_db()
-    logging.debug(f"Starting DNS server on {host}:{port}")
+class DNSListener:
+    """Reads queries off the listening socket in batches and answers each from its own task.
+
+    Each time the event loop reports the socket readable, drain() reads every
+    queued datagram (up to RECV_BATCH) into a preallocated buffer instead of
+    taking one datagram per loop iteration."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray(MAX_DATAGRAM)
+        self.tasks = set()
+
+    def drain(self):
+        for _ in range(RECV_BATCH):
+            try:
+                nbytes, _, flags, client_address = self.sock.recvmsg_into([self.buffer], 0, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.debug("Error receiving query: %s", e)
+                return
+            if flags & socket.MSG_TRUNC:
+                logging.debug("Dropping oversized query from %s", client_address)
+                continue
+
+            logging.debug("Received query from %s", client_address)
+            task = asyncio.create_task(self._handle(bytes(memoryview(self.buffer)[:nbytes]), client_address))
+            # Keep a reference so the task is not garbage collected mid-flight
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _handle(self, data, client_address):
+        try:
+            response = await handle_dns_query(data, client_address)
+        except Exception as e:
+            logging.error("Error handling query from %s: %s", client_address, e)
+            return
+        try:
+            self.sock.sendto(response, client_address)
+        except (BlockingIOError, InterruptedError):
+            # Send buffer full; the client retries over UDP anyway
+            logging.debug("Dropping response to %s, send buffer full", client_address)
+        except OSError as e:
+            logging.error("Error sending response to %s: %s", client_address, e)
+
+def open_dns_socket(host, port, reuse_port=False):
+    """Bind the UDP listening socket; with reuse_port, sibling worker processes can bind the same port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        # The kernel spreads incoming datagrams across all sockets bound this way
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+async def serve_dns(host, port, reuse_port=False):
+    """Serve DNS over UDP on host:port until cancelled."""
+    global _upstream_pool, _upstream_lock
+    _upstream_pool = [None] * UPSTREAM_POOL_SIZE
+    _upstream_lock = asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    sock = open_dns_socket(host, port, reuse_port)
+    sock.setblocking(False)
+    loop.add_reader(sock.fileno(), DNSListener(sock).drain)
+    await get_upstream()
+    logging.info("DNS server running on %s:%s (pid %s)...", host, port, os.getpid())
+    try:
+        await asyncio.Future()  # Run forever
+    finally:
+        loop.remove_reader(sock.fileno())
+        sock.close()
+
+def run_worker(host, port, special_domains, reuse_port=False):
+    """Run one DNS server process with its own listening socket and database connection."""
+    global _EXACT_DOMAINS, _DOMAIN_TRIE
+    _EXACT_DOMAINS, _DOMAIN_TRIE = index_special_domains(special_domains)
+    sqlite_database.connect_db()
+    asyncio.run(serve_dns(host, port, reuse_port))
+
+def start_dns_server(host='0.0.0.0', port=1053, config_file="config.yml", workers=None):
+    """Start a DNS server that loads domain configs from a YAML file.
+
+    Runs one worker process per CPU (or `workers`) sharing the port through
+    SO_REUSEPORT; falls back to a single process where that is unavailable."""
+    sqlite_database.drop_db()
+    logging.debug("Starting DNS server on %s:%s", host, port)
     try:
         config = load_config(config_file)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind((host, port))
-        logging.info(f"DNS server running on {host}:{port}...")
+        special_domains = config['special_domains']
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or not hasattr(socket, 'SO_REUSEPORT'):
+            run_worker(host, port, special_domains)
+            return
 
-        while True:
-            data, client_address = sock.recvfrom(512)  # DNS packet size max is 512 bytes
-            logging.info(f"Received query from {client_address}")
-            response = handle_dns_query(data, client_address, config)
-            sock.sendto(response, client_address)
+        logging.info("Starting %s DNS worker processes", workers)
+        processes = [multiprocessing.Process(target=run_worker, args=(host, port, special_domains, True),
+                                             daemon=True)
+                     for _ in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        failed = [process.exitcode for process in processes if process.exitcode]
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {workers} DNS workers failed (exit codes {failed})")
 
     except Exception as e:
-        logging.error(f"Error starting DNS server: {e}")
+        logging.error("Error starting DNS server: %s", e)
         raise
 
 if __name__ == '__main__':
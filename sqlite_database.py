@@ -1,110 +1,180 @@
 import logging
 import os
+import queue
 import sqlite3
+import threading
 import time
+from collections import OrderedDict
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-
-# SQLite database name
-DB_NAME = 'dns_resolutions.db'
-
-
-def create_db():
-    """Create or recreate the SQLite database and table."""
-    logging.debug(f"Creating/recreating database: {DB_NAME}")
-    if os.path.exists(DB_NAME):
-        os.remove(DB_NAME)  # Remove the existing DB if it exists
-
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS domain_resolutions (
-            domain TEXT NOT NULL,
-            subdomain TEXT,
-            ip TEXT NOT NULL,
-            timestamp INTEGER NOT NULL,
-            PRIMARY KEY (domain, subdomain)
-        )
-    ''')
-    conn.commit()
-    conn.close()
-    logging.info(f"Database {DB_NAME} created/recreated successfully.")
-
-
-def get_ip_from_db(domain, subdomain=None):
-    """Retrieve IP from the SQLite database."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    if subdomain:
-        cursor.execute("SELECT ip FROM domain_resolutions WHERE domain = ? AND subdomain = ?",
-                       (domain, subdomain))
-    else:
-        cursor.execute("SELECT ip FROM domain_resolutions WHERE domain = ? AND subdomain IS NULL", (domain,))
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        return result[0]
-    return None
-
-
-def store_ip_in_db(domain, subdomain, ip):
-    """Store the IP resolution in the SQLite database with the current timestamp."""
-    timestamp = int(time.time())  # Get current time in seconds since the epoch
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    # Delete any existing entry with the same domain and subdomain (if subdomain exists)
-    if subdomain:
-        cursor.execute(
-            "DELETE FROM domain_resolutions WHERE domain = ? AND subdomain = ?",
-            (domain, subdomain)
-        )
-    else:
-        cursor.execute(
-            "DELETE FROM domain_resolutions WHERE domain = ? AND subdomain IS NULL",
-            (domain,)
-        )
-
-    # Insert the new entry
-    if subdomain:
-        cursor.execute(
-            "INSERT OR REPLACE INTO domain_resolutions (domain, subdomain, ip, timestamp) VALUES (?, ?, ?, ?)",
-            (domain, subdomain, ip, timestamp))
-    else:
-        cursor.execute(
-            "INSERT OR REPLACE INTO domain_resolutions (domain, subdomain, ip, timestamp) VALUES (?, NULL, ?, ?)",
-            (domain, ip, timestamp))
-
-    conn.commit()
-    conn.close()
-
-def check_if_resolution_valid(domain, subdomain=None):
-    """Check the timestamp and remove entry if older than 5 minutes."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    five_minutes = 5 * 60  # 5 minutes in seconds
-    current_time = int(time.time())
-
-    if subdomain:
-        cursor.execute("SELECT timestamp FROM domain_resolutions WHERE domain = ? AND subdomain = ?",
-                       (domain, subdomain))
-    else:
-        cursor.execute("SELECT timestamp FROM domain_resolutions WHERE domain = ? AND subdomain IS NULL", (domain,))
-
-    result = cursor.fetchone()
-    if result:
-        timestamp = result[0]
-        if current_time - timestamp > five_minutes:
-            # If the timestamp is older than 5 minutes, delete the entry and return False
-            cursor.execute("DELETE FROM domain_resolutions WHERE domain = ? AND subdomain = ?",
-                           (domain, subdomain) if subdomain else (domain,))
-            conn.commit()
-            conn.close()
-            logging.info(f"Entry for {domain} {subdomain if subdomain else ''} removed due to timeout.")
-            return False
-        else:
-            # If the entry is still valid, return True
-            conn.close()
-            return True
-    conn.close()
-    return False
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# SQLite database name. The table is recreated on every start and only backs
+# the resolution cache, so it lives in memory by default; set a file path here
+# to keep it on disk instead.
+DB_NAME = ':memory:'
+
+# WITHOUT ROWID stores rows in primary key order, so a lookup by
+# (domain, subdomain) reads the row straight from the key b-tree. IPs are kept
+# packed (4 bytes for IPv4, 16 for IPv6) here and in the in-process cache.
+SQL_CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS domain_resolutions (
+        domain TEXT NOT NULL,
+        subdomain TEXT NOT NULL DEFAULT '',
+        ip BLOB NOT NULL,
+        timestamp INTEGER NOT NULL,
+        PRIMARY KEY (domain, subdomain)
+    ) WITHOUT ROWID
+'''
+# Rows without a subdomain store '' rather than NULL: SQLite treats NULLs as
+# distinct in the primary key, so only '' lets INSERT OR REPLACE find the old row.
+# Lookups skip rows older than the cutoff passed in; the writer thread deletes
+# them in one periodic sweep instead of per query.
+SQL_GET_ROW = "SELECT ip, timestamp FROM domain_resolutions WHERE domain = ? AND subdomain = ? AND timestamp >= ?"
+SQL_UPSERT = "INSERT OR REPLACE INTO domain_resolutions (domain, subdomain, ip, timestamp) VALUES (?, ?, ?, ?)"
+SQL_DELETE_EXPIRED = "DELETE FROM domain_resolutions WHERE timestamp < ?"
+
+# This process's connection, opened by connect_db(). sqlite3 keeps compiled statements
+# in a per-connection cache keyed by SQL text, so reusing one connection with
+# the constant statements above avoids reparsing them on every query.
+_conn = None
+_lock = threading.Lock()
+
+# In-process LRU of (domain, subdomain) -> (packed ip, expiry timestamp) in front of
+# SQLite, so repeated lookups never reach the database.
+RESOLUTION_TTL = 5 * 60  # seconds
+RESOLUTION_CACHE_SIZE = 4096
+_RESOLUTION_CACHE = OrderedDict()
+_cache_lock = threading.Lock()
+
+# Writes are handed to a single background thread which commits them in
+# batches, one transaction per batch.
+WRITE_QUEUE_SIZE = 10_000
+WRITE_BATCH_SIZE = 256
+SWEEP_INTERVAL = 60  # seconds between deletions of expired rows
+_write_q = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+_writer_thread = None
+
+
+def drop_db():
+    """Remove the database file left by a previous run, if DB_NAME is a file."""
+    if DB_NAME != ':memory:' and os.path.exists(DB_NAME):
+        logging.debug("Removing database: %s", DB_NAME)
+        os.remove(DB_NAME)
+
+
+def connect_db():
+    """Open this process's connection to the database and create the table if needed.
+
+    Each server worker process calls this for itself; connections and the writer
+    thread cannot be shared across fork()."""
+    global _conn, _writer_thread
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+        _conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None, cached_statements=128)
+        # Journal and mmap settings only apply when DB_NAME is a file
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute("PRAGMA mmap_size=67108864")  # 64 MiB
+        _conn.execute("PRAGMA cache_size=-8192")  # 8 MiB page cache
+        _conn.execute(SQL_CREATE_TABLE)
+    with _cache_lock:
+        _RESOLUTION_CACHE.clear()
+    if _writer_thread is None:
+        _writer_thread = threading.Thread(target=_writer, name="sqlite-writer", daemon=True)
+        _writer_thread.start()
+    logging.info("Database %s ready.", DB_NAME)
+
+
+def _cache_put(key, ip, expiry):
+    with _cache_lock:
+        _RESOLUTION_CACHE[key] = (ip, expiry)
+        _RESOLUTION_CACHE.move_to_end(key)
+        if len(_RESOLUTION_CACHE) > RESOLUTION_CACHE_SIZE:
+            _RESOLUTION_CACHE.popitem(last=False)
+
+
+def get_cached(domain, subdomain=None):
+    """Return the packed IP resolved for domain/subdomain if it is younger than 5 minutes, else None.
+
+    The in-process cache is consulted first; SQLite is only read on a miss."""
+    key = (domain, subdomain or '')
+    now = int(time.time())
+    with _cache_lock:
+        entry = _RESOLUTION_CACHE.get(key)
+        if entry is not None:
+            if now <= entry[1]:
+                _RESOLUTION_CACHE.move_to_end(key)
+                return entry[0]
+            del _RESOLUTION_CACHE[key]
+
+    with _lock:
+        result = _conn.execute(SQL_GET_ROW, key + (now - RESOLUTION_TTL,)).fetchone()
+    if not result:
+        return None
+    ip, timestamp = result
+    expiry = timestamp + RESOLUTION_TTL
+    _cache_put(key, ip, expiry)
+    return ip
+
+
+def _write_rows(rows):
+    """Write (domain, subdomain, ip, timestamp) rows in a single transaction."""
+    with _lock:
+        _conn.execute("BEGIN")
+        try:
+            _conn.executemany(SQL_UPSERT, rows)
+        except sqlite3.Error:
+            _conn.execute("ROLLBACK")
+            raise
+        _conn.execute("COMMIT")
+
+
+def _sweep_expired():
+    """Delete every row older than 5 minutes in one statement."""
+    with _lock:
+        deleted = _conn.execute(SQL_DELETE_EXPIRED, (int(time.time()) - RESOLUTION_TTL,)).rowcount
+    if deleted:
+        logging.debug("Removed %s expired resolutions", deleted)
+
+
+def _writer():
+    """Drain the write queue forever, committing up to WRITE_BATCH_SIZE rows per transaction.
+
+    Expired rows are swept every SWEEP_INTERVAL seconds from this same thread."""
+    next_sweep = time.monotonic() + SWEEP_INTERVAL
+    while True:
+        try:
+            batch = [_write_q.get(timeout=max(0, next_sweep - time.monotonic()))]
+        except queue.Empty:
+            batch = []
+        while batch and len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(_write_q.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            try:
+                _write_rows(batch)
+            except sqlite3.Error as e:
+                logging.error("Failed to store %s resolutions: %s", len(batch), e)
+
+        if time.monotonic() >= next_sweep:
+            next_sweep = time.monotonic() + SWEEP_INTERVAL
+            try:
+                _sweep_expired()
+            except sqlite3.Error as e:
+                logging.error("Failed to remove expired resolutions: %s", e)
+
+
+def queue_ip_for_storage(domain, subdomain, ip):
+    """Cache the packed IP resolution immediately and leave the SQLite write to the background writer."""
+    timestamp = int(time.time())
+    subdomain = subdomain or ''
+    _cache_put((domain, subdomain), ip, timestamp + RESOLUTION_TTL)
+    try:
+        _write_q.put_nowait((domain, subdomain, ip, timestamp))
+    except queue.Full:
+        logging.debug("Write queue full, not persisting resolution for %s %s", domain, subdomain)